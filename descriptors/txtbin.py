@@ -5,34 +5,43 @@ other packages.
 
 import numpy as np
 
-from skimage.filters.rank import median
+from scipy import ndimage as nd
 from skimage.morphology import disk
 
 
-def compactness(_img):
+## Lookup table for the empirical distribution of median(img)/img
+## in the case of a random image (white noise), for varying
+## proportions of white pixels in the image (0.1, 0.2, ..., 1.0).
+## The distributions are approximated by Gaussians, and the
+## corresponding means and standard deviations are stored.
+_COMPACTNESS_PROP = np.linspace(0.1, 1.0, 10)
+_COMPACTNESS_MU = np.array([4.4216484763437432e-06, 0.0011018116582350559,
+                            0.042247116747488218, 0.34893587605251208,
+                            1.0046008733628913, 1.4397675817057451,
+                            1.4115741958770296, 1.2497935146232551,
+                            1.1111058415275834, 1.0])
+_COMPACTNESS_SD = np.array([2.7360459073474441e-05, 0.00051125394394966434,
+                            0.0038856377648490894, 0.012029872915543046,
+                            0.013957075037020938, 0.0057246251730834283,
+                            0.0028750796874699143, 0.0023709207886137384,
+                            0.0015018959493632007, 0.0])
+
+## Neighborhood of the median filter
+_COMPACTNESS_DISK = disk(3).astype(np.int32)
+
 
-    ## Lookup table for the empirical distribution of median(img)/img
-    ## in the case of a random image (white noise), for varying
-    ## proportions of white pixels in the image (0.1, 0.2, ..., 1.0).
-    ## The distributions are approximated by Gaussians, and the
-    ## corresponding means and standard deviations are stored.
-
-    prop = np.linspace(0.1, 1.0, 10)
-    emp_distrib_mean = np.array([4.4216484763437432e-06, 0.0011018116582350559,
-                                 0.042247116747488218, 0.34893587605251208,
-                                 1.0046008733628913, 1.4397675817057451,
-                                 1.4115741958770296, 1.2497935146232551,
-                                 1.1111058415275834, 1.0])
-    emp_distrib_std = np.array([2.7360459073474441e-05, 0.00051125394394966434,
-                                0.0038856377648490894, 0.012029872915543046,
-                                0.013957075037020938, 0.0057246251730834283,
-                                0.0028750796874699143, 0.0023709207886137384,
-                                0.0015018959493632007, 0.0])
+def compactness(_img):
     if _img.ndim != 2:
         raise ValueError('The input image must be a 2D binary image.')
 
     _img = (_img != 0).astype(np.uint8)
-    _med = median(_img, disk(3))
+
+    # median filter over disk(3) of the binary image (as skimage.filters.rank.median,
+    # which only considers the neighbors within the image): the median is 1 iff
+    # there are at least as many 1s as 0s in the neighborhood, i.e. iff the sum
+    # of +1 (for 1s) and -1 (for 0s) over the neighborhood is non-negative
+    _med = (nd.convolve(2 * _img.astype(np.int32) - 1, _COMPACTNESS_DISK,
+                        mode='constant', cval=0) >= 0).astype(np.uint8)
 
     # "proportion of white pixels" in the image:
     swp = np.sum(_img, dtype=np.float64)
@@ -43,9 +52,9 @@ def compactness(_img):
 
     # standardize using the "closest" Gaussian from the list of empirical
     # distributions:
-    k = np.argmin(np.abs(prop - pwp))
+    k = np.argmin(np.abs(_COMPACTNESS_PROP - pwp))
 
     # this should make the coeff more or less normally distributed N(0,1)
-    cf = (cf - emp_distrib_mean[k]) / emp_distrib_std[k]
+    cf = (cf - _COMPACTNESS_MU[k]) / _COMPACTNESS_SD[k]
 
     return cf
\ No newline at end of file
@@ -18,22 +18,87 @@ from scipy.stats.mstats import kurtosis, skew
 from matplotlib.cbook import flatten
 from future.utils import bytes_to_native_str as nstr
 
-from scipy import ndimage as nd
 from scipy.linalg import norm
 from scipy.stats import entropy
 from scipy.signal import convolve2d
 
 from skimage.filters import gabor_kernel
 from skimage.util import img_as_float
-from skimage.feature.texture import greycoprops, greycomatrix, \
-    local_binary_pattern
+from skimage.feature.texture import local_binary_pattern
 from skimage.exposure import rescale_intensity
 from skimage.feature import hog
 # from skimage.transform import integral_image
 
+from numba import njit, prange
+from joblib import Parallel, delayed, cpu_count
+
 from .basic import *
 
 
+# distance methods between feature vectors
+def _euclidean(x_, y_):
+    return norm(x_ - y_)
+
+
+def _cosine(x_, y_):
+    return dot(x_, y_) / (norm(x_) * norm(y_))
+
+
+_DM_VECTOR = {'euclidean': _euclidean,
+              'cosine': _cosine
+              }
+
+
+# distance methods between histograms. The histograms are either plain
+# vectors or "prepared" pairs (h, sqrt(h)) - see _prepare_hist()
+def _prepare_hist(h):
+    """
+    Return the pair (h, sqrt(h)), such that the square roots needed by the
+    Bhattacharyya and Matusita distances are computed only once per histogram.
+    """
+    return h, np.sqrt(h)
+
+
+def _hist(x_):
+    return x_[0] if isinstance(x_, tuple) else x_
+
+
+def _sqrt_hist(x_):
+    return x_[1] if isinstance(x_, tuple) else np.sqrt(x_)
+
+
+def _kl(x_, y_):
+    x_, y_ = _hist(x_), _hist(y_)
+    return 0.5 * (entropy(x_, y_) + entropy(y_, x_))
+
+
+def _js(x_, y_):
+    x_, y_ = _hist(x_), _hist(y_)
+    return 0.5 * (entropy(x_, 0.5 * (x_ + y_)) + entropy(y_, 0.5 * (x_ + y_)))
+
+
+def _bh(x_, y_):
+    if isinstance(x_, tuple) or isinstance(y_, tuple):
+        return -np.log(np.sum(_sqrt_hist(x_) * _sqrt_hist(y_)))
+    return -np.log(np.sum(np.sqrt(x_ * y_)))
+
+
+def _ma(x_, y_):
+    return np.sqrt(np.sum((_sqrt_hist(x_) - _sqrt_hist(y_)) ** 2))
+
+
+_DM_HIST = {'kl': _kl,
+            'js': _js,
+            'bh': _bh,
+            'ma': _ma
+            }
+
+
+# number of Gabor kernels whose responses are computed (and held in memory)
+# together
+_GABOR_GROUP = 4
+
+
 class GaborDescriptor(LocalDescriptor):
     """
     Computes Gabor descriptors from an image. These descriptors are the means 
@@ -70,8 +135,47 @@ class GaborDescriptor(LocalDescriptor):
             for k, krn in enumerate(self.kernels_):
                 self.kernels_[k] = krn / np.sqrt((krn ** 2).sum())
 
+        # store the whole bank in a single contiguous (float32) array, with
+        # the (odd-sized) kernels zero-padded around their centers to a common
+        # shape; the individual kernels are views on this array
+        kh = max([krn.shape[0] for krn in self.kernels_])
+        kw = max([krn.shape[1] for krn in self.kernels_])
+        self.K = np.zeros((len(self.kernels_), kh, kw), dtype=np.float32)
+        for k, krn in enumerate(self.kernels_):
+            y0, x0 = (kh - krn.shape[0]) // 2, (kw - krn.shape[1]) // 2
+            self.K[k, y0:y0 + krn.shape[0], x0:x0 + krn.shape[1]] = krn
+            self.kernels_[k] = self.K[k, y0:y0 + krn.shape[0], x0:x0 + krn.shape[1]]
+
+        # the FFTs of the kernels depend on the image shape, so they are
+        # computed (and cached) at the first call of compute()
+        self.kernel_ffts_ = None
+        self.fft_shape_ = None
+
         return
 
+    def _kernel_ffts(self, shape):
+        """
+        Return the real FFTs of the kernels, zero-padded to the given shape,
+        stacked in a 3D array (one kernel per plane). The kernels are placed
+        with their center at the origin and wrapped around the borders, such
+        that the product with the FFT of an image corresponds to the circular
+        convolution (i.e. scipy.ndimage.convolve(..., mode='wrap')).
+        """
+        if self.fft_shape_ != shape:
+            nk, kh, kw = self.K.shape
+            rows = (np.arange(kh) - kh // 2) % shape[0]
+            cols = (np.arange(kw) - kw // 2) % shape[1]
+            self.kernel_ffts_ = np.empty((nk, shape[0], shape[1] // 2 + 1), dtype=np.complex64)
+            for k0 in range(0, nk, _GABOR_GROUP):   # (by groups, to bound the memory)
+                k1 = min(k0 + _GABOR_GROUP, nk)
+                pad = np.zeros((k1 - k0,) + tuple(shape), dtype=np.float32)
+                # kernels larger than the image are folded:
+                np.add.at(pad, (slice(None), rows[:, np.newaxis], cols[np.newaxis, :]), self.K[k0:k1])
+                self.kernel_ffts_[k0:k1] = np.fft.rfft2(pad)
+            self.fft_shape_ = shape
+
+        return self.kernel_ffts_
+
     def compute(self, image):
         """
         Compute the Gabor descriptors on the given image.
@@ -84,16 +188,23 @@ class GaborDescriptor(LocalDescriptor):
             numpy.ndarray (vector) containing the Gabor descriptors (means followed
             by the variances of the filter responses)
         """
-        try:
-            image = img_as_float(image)
-            nk = len(self.kernels_)
-            ft = np.zeros(2 * nk, dtype=np.double)
-            for k, krn in enumerate(self.kernels_):
-                flt = nd.convolve(image, krn, mode='wrap')
-                ft[k] = flt.mean()
-                ft[k + nk] = flt.var()
-        except:
-            print("Error in GaborDescriptor.compute()")
+        image = img_as_float(image).astype(np.float32)
+        nk = self.K.shape[0]
+        n = image.size
+        ft = np.zeros(2 * nk, dtype=np.double)
+        # the convolutions are performed in frequency domain, with a single
+        # forward transform of the image for the whole bank of filters; the
+        # inverse transforms are batched over small groups of kernels, to keep
+        # the memory bounded
+        F = np.fft.rfft2(image)
+        Kf = self._kernel_ffts(image.shape)
+        for k0 in range(0, nk, _GABOR_GROUP):
+            k1 = min(k0 + _GABOR_GROUP, nk)
+            flt = np.fft.irfft2(Kf[k0:k1] * F, s=image.shape)
+            # means and variances from one pass over the responses: E[X], E[X^2]
+            # (accumulated in double precision, the responses being float32)
+            ft[k0:k1] = np.einsum('kij->k', flt, dtype=np.float64) / n
+            ft[nk + k0:nk + k1] = np.einsum('kij,kij->k', flt, flt, dtype=np.float64) / n - ft[k0:k1] ** 2
 
         return ft
 
@@ -106,19 +217,135 @@ class GaborDescriptor(LocalDescriptor):
             -cosine distance: this is not a proper distance! 
         
         """
-        dm = {'euclidean': lambda x_, y_: norm(x_ - y_),
-              'cosine': lambda x_, y_: dot(x_, y_) / (norm(x_) * norm(y_))
-              }
         method = method.lower()
-        if method not in dm:
+        if method not in _DM_VECTOR:
             raise ValueError('Unknown method')
 
-        return dm[method](ft1, ft2)
+        return _DM_VECTOR[method](ft1, ft2)
 
 
 ## end class GaborDescriptors
 
 
+# number of GLCM windows (vertically and horizontally) processed together,
+# such that the image rows they span stay in cache
+_GLCM_TILE_H, _GLCM_TILE_W = 4, 4
+
+# (approximate) upper bound on the memory used by the GLCMs of a group of
+# windows, in float64 (see GLCMDescriptor.compute())
+_GLCM_GROUP_BYTES = 16 * 2 ** 20
+
+
+@njit(parallel=True)
+def _glcm_blocks(img, wsize, dy, dx, levels, nh, nw, symmetric, out):
+    """
+    Accumulate the co-occurrence matrices of all non-overlapping <wsize x wsize>
+    blocks of a quantized image into out[by, bx, :, :] (out must be zeroed).
+    The pairs are (img[y, x], img[y+dy, x+dx]), with both pixels in the same
+    block (as in skimage.feature.greycomatrix applied to each block).
+    The blocks are visited row-wise, in tiles of _GLCM_TILE_H x _GLCM_TILE_W
+    blocks.
+    """
+    nth = (nh + _GLCM_TILE_H - 1) // _GLCM_TILE_H
+    ntw = (nw + _GLCM_TILE_W - 1) // _GLCM_TILE_W
+    for t in prange(nth * ntw):
+        by0 = (t // ntw) * _GLCM_TILE_H
+        bx0 = (t % ntw) * _GLCM_TILE_W
+        for by in range(by0, min(by0 + _GLCM_TILE_H, nh)):
+            for bx in range(bx0, min(bx0 + _GLCM_TILE_W, nw)):
+                y0, x0 = by * wsize, bx * wsize
+                y1, x1 = y0 + wsize, x0 + wsize
+                for y in range(max(y0, y0 - dy), min(y1, y1 - dy)):
+                    for x in range(max(x0, x0 - dx), min(x1, x1 - dx)):
+                        out[by, bx, img[y, x], img[y + dy, x + dx]] += 1
+                if symmetric:
+                    for i in range(levels):
+                        out[by, bx, i, i] *= 2
+                        for j in range(i + 1, levels):
+                            v = out[by, bx, i, j] + out[by, bx, j, i]
+                            out[by, bx, i, j] = v
+                            out[by, bx, j, i] = v
+
+    return
+
+
+def _glcm_weights(levels, which):
+    """
+    Build the weight matrices W[w, i, j] of all the GLCM features (and of the
+    moments needed by them) that are linear in the co-occurrence matrix, for
+    the features in <which>.
+
+    Returns:
+        (W, idx) with idx mapping a feature/moment name to its row in W
+    """
+    i = np.arange(levels, dtype=np.float64)
+    I, J = np.meshgrid(i, i, indexing='ij')
+    grids = {'contrast': lambda: (I - J) ** 2,
+             'dissimilarity': lambda: np.abs(I - J),
+             'homogeneity': lambda: 1.0 / (1.0 + (I - J) ** 2),
+             'i': lambda: I, 'j': lambda: J,
+             'i2': lambda: I ** 2, 'j2': lambda: J ** 2,
+             'ij': lambda: I * J}
+
+    names = []
+    for f in which:
+        if f in ('contrast', 'dissimilarity', 'homogeneity'):
+            names.append(f)
+        elif f == 'correlation':
+            names.extend(['i', 'j', 'i2', 'j2', 'ij'])
+        elif f not in ('asm', 'energy'):
+            raise ValueError('Unknown GLCM feature: ' + f)
+
+    idx = {}
+    for n in names:
+        if n not in idx:
+            idx[n] = len(idx)
+    W = np.zeros((len(idx), levels, levels), dtype=np.float64)
+    for n, k in idx.items():
+        W[k] = grids[n]()
+
+    return W, idx
+
+
+def _glcm_props(P, which, W, widx):
+    """
+    Compute the GLCM features (see skimage.feature.greycoprops) for a stack of
+    co-occurrence matrices P[..., i, j]. The matrices are normalized to sum
+    to 1 before computing the features. W and widx are the weights of the
+    linear features, as returned by _glcm_weights(): all of them are obtained
+    from a single pass over P.
+
+    Returns:
+        list with an array of shape P.shape[:-2] for each feature in <which>
+    """
+    total = np.einsum('...ij->...', P, dtype=np.float64)
+    total[total == 0] = 1.0
+
+    # all the linear features/moments at once:
+    m = np.einsum('wij,...ij->...w', W, P, dtype=np.float64) / total[..., np.newaxis]
+
+    res = []
+    for f in which:
+        if f in ('contrast', 'dissimilarity', 'homogeneity'):
+            v = m[..., widx[f]]
+        elif f == 'asm' or f == 'energy':
+            v = np.einsum('...ij,...ij->...', P, P, dtype=np.float64) / total ** 2
+            if f == 'energy':
+                v = np.sqrt(v)
+        else:  # 'correlation'
+            mu_i, mu_j = m[..., widx['i']], m[..., widx['j']]
+            std_i = np.sqrt(np.maximum(m[..., widx['i2']] - mu_i ** 2, 0.0))
+            std_j = np.sqrt(np.maximum(m[..., widx['j2']] - mu_j ** 2, 0.0))
+            cov = m[..., widx['ij']] - mu_i * mu_j
+            # constant regions have correlation 1 (as in greycoprops):
+            v = np.ones(total.shape)
+            msk = (std_i >= 1e-15) & (std_j >= 1e-15)
+            v[msk] = cov[msk] / (std_i[msk] * std_j[msk])
+        res.append(v)
+
+    return res
+
+
 class GLCMDescriptor(LocalDescriptor):
     """
     Grey Level Co-occurrence Matrix: the image is decomposed into a number of
@@ -139,11 +366,12 @@ class GLCMDescriptor(LocalDescriptor):
             the last row in an image are smaller than the required size, then they are not
             used in computing the features.
 
-            dist: uint
-            pair distance
+            dist: uint or sequence of uint
+            pair distance; if a sequence is given (as for skimage's greycomatrix),
+            only its first element is used
             
-            theta: float
-            pair angle
+            theta: float or sequence of float
+            pair angle; if a sequence is given, only its first element is used
             
             levels: uint
             number of grey levels
@@ -168,6 +396,9 @@ class GLCMDescriptor(LocalDescriptor):
         self.symmetric_ = symmetric
         self.normed_ = normed
 
+        # weights for computing the features from the GLCMs:
+        self._glcm_w, self._glcm_widx = _glcm_weights(self.levels_, self.which_feats_)
+
         return
 
     def compute(self, image):
@@ -176,31 +407,59 @@ class GLCMDescriptor(LocalDescriptor):
         """
 
         assert (image.ndim == 2)
-        w, h = image.shape
+        # quantize once to [0, levels) and the smallest index type:
+        img = np.clip(image, 0, self.levels_ - 1).astype(np.uint8 if self.levels_ <= 256 else np.uint16)
+        h, w = img.shape
 
         nw = int(w / self.wsize_)
         nh = int(h / self.wsize_)
 
-        nf = len(self.which_feats_)
-
-        ft = np.zeros((nf, nw * nh))  # features will be on rows
-        k = 0
-        for x in np.arange(0, nw):
-            for y in np.arange(0, nh):
-                x0, y0 = x * self.wsize_, y * self.wsize_
-                x1, y1 = x0 + self.wsize_, y0 + self.wsize_
-
-                glcm = greycomatrix(image[y0:y1, x0:x1],
-                                    self.dist_, self.theta_, self.levels_,
-                                    self.symmetric_, self.normed_)
-                ft[:, k] = np.array([greycoprops(glcm, f)[0, 0] for f in self.which_feats_])
-                k += 1
-
+        if nw == 0 or nh == 0:
+            # no complete window in the image
+            return dict([(f, np.zeros(0)) for f in self.which_feats_])
+
+        # pair offset, as in skimage.feature.greycomatrix:
+        d, t = np.ravel(self.dist_)[0], np.ravel(self.theta_)[0]
+        dy = int(np.round(np.sin(t) * d))
+        dx = int(np.round(np.cos(t) * d))
+
+        # (a count is at most 2*wsize^2, for the diagonal of a symmetric GLCM)
+        cnt_type = np.uint16 if 2 * self.wsize_ ** 2 < 2 ** 16 else np.uint32
+
+        # the GLCMs are built and reduced over groups of (at most nb) windows,
+        # to keep the memory bounded. If possible, the groups are made of whole
+        # tiles of _GLCM_TILE_H x _GLCM_TILE_W windows (and of whole rows of
+        # tiles), such that _glcm_blocks() works on complete tiles:
+        nb = max(1, _GLCM_GROUP_BYTES // (8 * self.levels_ ** 2))
+        if nb < _GLCM_TILE_H * _GLCM_TILE_W:
+            gh, gw = (max(1, nb // nw), nw) if nw <= nb else (1, nb)
+        elif nw * _GLCM_TILE_H <= nb:
+            gh, gw = (nb // nw) // _GLCM_TILE_H * _GLCM_TILE_H, nw
+        else:
+            gh, gw = _GLCM_TILE_H, (nb // _GLCM_TILE_H) // _GLCM_TILE_W * _GLCM_TILE_W
+
+        ft = np.zeros((len(self.which_feats_), nh, nw))
+        with Parallel(n_jobs=-1, prefer='threads') as parallel:
+            for by0 in range(0, nh, gh):
+                for bx0 in range(0, nw, gw):
+                    by1, bx1 = min(by0 + gh, nh), min(bx0 + gw, nw)
+                    glcm = np.zeros((by1 - by0, bx1 - bx0, self.levels_, self.levels_), dtype=cnt_type)
+                    _glcm_blocks(img[by0 * self.wsize_:by1 * self.wsize_, bx0 * self.wsize_:bx1 * self.wsize_],
+                                 self.wsize_, dy, dx, self.levels_, by1 - by0, bx1 - bx0, self.symmetric_, glcm)
+
+                    # the features are computed in parallel (threads), on chunks of
+                    # windows:
+                    P = glcm.reshape((-1, self.levels_, self.levels_))
+                    chunks = np.array_split(P, max(1, min(P.shape[0], cpu_count())), axis=0)
+                    props = parallel(delayed(_glcm_props)(C, self.which_feats_, self._glcm_w, self._glcm_widx)
+                                     for C in chunks)
+                    for i in range(len(self.which_feats_)):
+                        ft[i, by0:by1, bx0:bx1] = np.concatenate([p[i] for p in props]).reshape(glcm.shape[:2])
+
+        # the windows are enumerated column-wise:
         res = {}
-        k = 0
-        for f in self.which_feats_:
-            res[f] = ft[k, :]
-            k += 1
+        for i, f in enumerate(self.which_feats_):
+            res[f] = ft[i].T.ravel()
 
         return res
 
@@ -227,15 +486,8 @@ class GLCMDescriptor(LocalDescriptor):
             dict
             a dictionary with distances computed between pairs of features
         """
-        # distance methods
-        dm = {'kl': lambda x_, y_: 0.5 * (entropy(x_, y_) + entropy(y_, x_)),
-              'js': lambda x_, y_: 0.5 * (entropy(x_, 0.5 * (x_ + y_)) + entropy(y_, 0.5 * (x_ + y_))),
-              'bh': lambda x_, y_: -np.log(np.sum(np.sqrt(x_ * y_))),
-              'ma': lambda x_, y_: np.sqrt(np.sum((np.sqrt(x_) - np.sqrt(y_)) ** 2))
-              }
-
         method = method.lower()
-        if method not in dm.keys():
+        if method not in _DM_HIST:
             raise ValueError('Unknown method')
 
         res = {}
@@ -246,7 +498,7 @@ class GLCMDescriptor(LocalDescriptor):
                 mx = max(ft1[k].max(), ft2[k].max())
                 h1, _ = np.histogram(ft1[k], normed=True, bins=10, range=(mn, mx))
                 h2, _ = np.histogram(ft2[k], normed=True, bins=10, range=(mn, mx))
-                res[k] = dm[method](h1, h2)
+                res[k] = _DM_HIST[method](h1, h2)
 
         return res
 
@@ -289,11 +541,13 @@ class LBPDescriptor(LocalDescriptor):
         Compute the LBP features. These features are returned as histograms of 
         LBPs.
         """
-        try:
-            lbp = local_binary_pattern(image, self.npoints_, self.radius_, self.method_)
+        lbp = local_binary_pattern(image, self.npoints_, self.radius_, self.method_)
+        if self.method_ == 'uniform':
+            # the codes are integers in [0, nhbins_): just count them
+            counts = np.bincount(lbp.ravel().astype(np.intp), minlength=self.nhbins_)
+            hist = counts / counts.sum()
+        else:
             hist, _ = np.histogram(lbp, normed=True, bins=self.nhbins_, range=(0, self.nhbins_))
-        except:
-            print("Error in LBPDescriptor.compute()")
 
         return hist
 
@@ -305,8 +559,8 @@ class LBPDescriptor(LocalDescriptor):
         are represented as histograms of LBPs.
         
         Args:
-            ft1, ft2: numpy.ndarray (vector)
-            histograms of LBPs as returned by compute()
+            ft1, ft2: numpy.ndarray (vector) or tuple
+            histograms of LBPs as returned by compute() or prepare()
             
             method: string
             the method used for computing the distance between the two sets of features:
@@ -315,23 +569,83 @@ class LBPDescriptor(LocalDescriptor):
             'bh' - Bhattacharyya distance: -log(sqrt(sum_i (p_i*q_i)))
             'ma' - Matusita distance: sqrt(sum_i (sqrt(p_i)-sqrt(q_i))**2)
         """
-        # distance methods
-        dm = {'kl': lambda x_, y_: 0.5 * (entropy(x_, y_) + entropy(y_, x_)),
-              'js': lambda x_, y_: 0.5 * (entropy(x_, 0.5 * (x_ + y_)) + entropy(y_, 0.5 * (x_ + y_))),
-              'bh': lambda x_, y_: -np.log(np.sum(np.sqrt(x_ * y_))),
-              'ma': lambda x_, y_: np.sqrt(np.sum((np.sqrt(x_) - np.sqrt(y_)) ** 2))
-              }
-
         method = method.lower()
-        if method not in dm.keys():
+        if method not in _DM_HIST:
             raise ValueError('Unknown method')
 
-        return dm[method](ft1, ft2)
+        return _DM_HIST[method](ft1, ft2)
+
+    @staticmethod
+    def prepare(ft):
+        """
+        Prepares a histogram of LBPs for repeated distance computations (e.g. all
+        pairwise distances): the square roots used by the 'bh' and 'ma' methods
+        are computed only once. The result can be passed to dist() instead of
+        the histogram.
+
+        Args:
+            ft: numpy.ndarray (vector)
+            histogram of LBPs as returned by compute()
+
+        Returns:
+            tuple (ft, sqrt(ft))
+        """
+        return _prepare_hist(ft)
 
 
 # end class LBPDescriptors
 
 
+@njit(parallel=True)
+def _mfs_counts(idx_im, nlabels, niter, out):
+    """
+    Box-counting for all level sets at once: out[j-1, k] is incremented by the
+    number of boxes at scale j (j=1..niter) containing at least one pixel with
+    label k (k=0..nlabels). The label image is scanned once per scale.
+
+    The boxes are sampled with a step of j pixels; for j > 1 the box at (a, b)
+    covers the rows a-j+2..a+1 and the columns b-j+2..b+1 (clipped to the image),
+    i.e. the boxes used by the original convolve2d(..., mode="full")[1:, 1:]
+    implementation. For j = 1 the boxes are the pixels.
+    """
+    h, w = idx_im.shape
+    for j in range(1, niter + 1):
+        off = 2 if j > 1 else 1
+        nby = (h + j - 1) // j
+        rc = np.zeros((nby, nlabels + 1), dtype=np.int64)  # counts per row of boxes
+        for t in prange(nby):
+            a = t * j
+            r0, r1 = max(0, a + off - j), min(h, a + off)
+            seen = np.zeros(nlabels + 1, dtype=np.int64)  # last box (1-based) containing each label
+            for b in range(0, w, j):
+                c0, c1 = max(0, b + off - j), min(w, b + off)
+                for y in range(r0, r1):
+                    for x in range(c0, c1):
+                        v = idx_im[y, x]
+                        if seen[v] != b + 1:
+                            seen[v] = b + 1
+                            rc[t, v] += 1
+        for t in range(nby):
+            for k in range(nlabels + 1):
+                out[j - 1, k] += rc[t, k]
+
+    return
+
+
+def _gauss_krn(size):
+    """ Returns a normalized 2D gauss kernel array for convolutions """
+    if size <= 3:
+        sigma = 1.5
+    else:
+        sigma = size / 2.0
+
+    y, x = np.mgrid[-(size - 1.0) / 2.0:(size - 1.0) / 2.0 + 1, -(size - 1.0) / 2.0:(size - 1.0) / 2.0 + 1]
+    s2 = 2.0 * sigma ** 2
+    g = np.exp(-(x ** 2 + y ** 2) / s2)
+
+    return g / g.sum()
+
+
 # MFSDescriptors - Multi-Fractal Dimensions 
 class MFSDescriptor(LocalDescriptor):
     """
@@ -356,6 +670,10 @@ class MFSDescriptor(LocalDescriptor):
         self.wsize = _wsize
         self.niter = _niter
 
+        # Gaussian kernels for the density estimation at levels 1..nlevels_avg-1
+        # (in single precision, like the density estimation itself)
+        self._gkernels = [_gauss_krn(k + 1).astype(np.float32) for k in range(1, self.nlevels_avg)]
+
         return
 
     def compute(self, im):
@@ -384,40 +702,26 @@ class MFSDescriptor(LocalDescriptor):
         ### by solving least squares for D in  the equation  
         ### log10(bw) = D*log10(c) + b 
         r = 1.0 / max(im.shape)
-        c = np.log10(r * np.arange(start=1, stop=self.nlevels_avg + 1))
+        # (the whole density estimation is done in single precision)
+        c = np.log10(r * np.arange(start=1, stop=self.nlevels_avg + 1)).astype(np.float32)
 
         bw = np.zeros((self.nlevels_avg, im.shape[0], im.shape[1]), dtype=np.float32)
         bw[0, :, :] = im + 1
 
-        def _gauss_krn(size):
-            """ Returns a normalized 2D gauss kernel array for convolutions """
-            if size <= 3:
-                sigma = 1.5
-            else:
-                sigma = size / 2.0
-
-            y, x = np.mgrid[-(size - 1.0) / 2.0:(size - 1.0) / 2.0 + 1, -(size - 1.0) / 2.0:(size - 1.0) / 2.0 + 1]
-            s2 = 2.0 * sigma ** 2
-            g = np.exp(-(x ** 2 + y ** 2) / s2)
-
-            return g / g.sum()
-
         k = 1
         if self.nlevels_avg > 1:
-            bw[1, :, :] = convolve2d(bw[0, :, :], _gauss_krn(k + 1), mode="full")[1:, 1:] * ((k + 1) ** 2)
+            bw[1, :, :] = convolve2d(bw[0, :, :], self._gkernels[k - 1], mode="full")[1:, 1:] * ((k + 1) ** 2)
 
         for k in np.arange(2, self.nlevels_avg):
-            temp = convolve2d(bw[0, :, :], _gauss_krn(k + 1), mode="full") * ((k + 1) ** 2)
+            temp = convolve2d(bw[0, :, :], self._gkernels[k - 1], mode="full") * ((k + 1) ** 2)
             if k == 4:
                 bw[k] = temp[k - 1 - 1:temp.shape[0] - (k / 2), k - 1 - 1:temp.shape[1] - (k / 2)]
             else:
                 bw[k] = temp[k - 1:temp.shape[0] - (1), k - 1:temp.shape[1] - (1)]
 
-        bw = np.log10(bw)
+        bw = np.log10(bw, out=bw)
         n1 = np.sum(c ** 2)
-        n2 = bw[0] * c[0]
-        for k in np.arange(1, self.nlevels_avg):
-            n2 += bw[k] * c[k]
+        n2 = np.tensordot(c, bw, axes=(0, 0))  # sum_k c[k] * bw[k]
 
         sum3 = np.sum(bw, axis=0)
 
@@ -431,56 +735,31 @@ class MFSDescriptor(LocalDescriptor):
         D = D[self.nlevels_avg - 1:D.shape[0] - self.nlevels_avg + 1,
             self.nlevels_avg - 1:D.shape[1] - self.nlevels_avg + 1]
 
-        IM = np.zeros(D.shape)
-        gap = np.ceil((grayscale_box[1] - grayscale_box[0]) / np.float32(self.wsize))
-        center = np.zeros(self.wsize)
-        for k in np.arange(1, self.wsize + 1):
-            bin_min = (k - 1) * gap
-            bin_max = k * gap - 1
-            center[k - 1] = round((bin_min + bin_max) / 2.0)
-            D = ((D <= bin_max) & (D >= bin_min)).choose(D, center[k - 1])
-
-        D = ((D >= bin_max)).choose(D, 0)
-        D = ((D < 0)).choose(D, 0)
-        IM = D
+        # Construct level sets: the k-th bin is [(k-1)*gap, k*gap-1] and its
+        # pixels get the label k (k=1..wsize); pixels outside all bins get 0.
+        # (Unlike the original imfractal-based code, which also counted the
+        # values left between bins that were >= 255+k as members of level k -
+        # this could happen for nlevels_avg > 1 and D > 255.)
+        gap = np.float32(np.ceil((grayscale_box[1] - grayscale_box[0]) / np.float32(self.wsize)))
+        edges = np.arange(1, self.wsize + 1, dtype=np.float32) * gap
+        idx = np.digitize(D, edges)
+        Idx_IM = np.where((D >= 0) & (idx < self.wsize) & (D <= (idx + 1) * gap - 1), idx + 1, 0)
+        Idx_IM = Idx_IM.astype(np.uint8 if self.wsize < 256 else np.uint16)
 
         # Constructing the filter for approximating log fitting
-        r = max(IM.shape)
+        r = max(Idx_IM.shape)
         c = np.zeros(self.niter)
         c[0] = 1;
         for k in range(1, self.niter):
             c[k] = c[k - 1] / (k + 1)
         c = c / sum(c);
 
-        # Construct level sets
-        Idx_IM = np.zeros(IM.shape);
-        for k in range(0, self.wsize):
-            IM = (IM == center[k]).choose(IM, k + 1)
-
-        Idx_IM = IM
-        IM = np.zeros(IM.shape)
-
         # Estimate MFS by box-counting
-        num = np.zeros(self.niter)
-        MFS = np.zeros(self.wsize)
-        for k in range(1, self.wsize + 1):
-            IM = np.zeros(IM.shape)
-            IM = (Idx_IM == k).choose(Idx_IM, 255 + k)
-            IM = (IM < 255 + k).choose(IM, 0)
-            IM = (IM > 0).choose(IM, 1)
-            temp = max(IM.sum(), 1)
-            num[0] = np.log10(temp) / np.log10(r);
-            for j in range(2, self.niter + 1):
-                mask = np.ones((j, j))
-                bw = convolve2d(IM, mask, mode="full")[1:, 1:]
-                indx = np.arange(0, IM.shape[0], j)
-                indy = np.arange(0, IM.shape[1], j)
-                bw = bw[np.ix_(indx, indy)]
-                idx = (bw > 0).sum()
-                temp = max(idx, 1)
-                num[j - 1] = np.log10(temp) / np.log10(r / j)
-
-            MFS[k - 1] = sum(c * num)
+        cnt = np.zeros((self.niter, self.wsize + 1), dtype=np.int64)
+        _mfs_counts(Idx_IM, self.wsize, self.niter, cnt)
+        num = np.log10(np.maximum(cnt[:, 1:], 1)) / \
+              np.log10(r / np.arange(1, self.niter + 1, dtype=np.float64))[:, np.newaxis]
+        MFS = np.dot(c, num)
 
         return MFS
 
@@ -496,14 +775,11 @@ class MFSDescriptor(LocalDescriptor):
         assert (ft1.ndim == ft2.ndim == 1)
         assert (ft1.size == ft2.size)
 
-        dm = {'euclidean': lambda x_, y_: norm(x_ - y_),
-              'cosine': lambda x_, y_: dot(x_, y_) / (norm(x_) * norm(y_))
-              }
         method = method.lower()
-        if method not in dm.keys():
+        if method not in _DM_VECTOR:
             raise ValueError('Unknown method')
 
-        return dm[method](ft1, ft2)
+        return _DM_VECTOR[method](ft1, ft2)
 
 
 # end class MFSDescriptors
@@ -557,15 +833,11 @@ class HOGDescriptor(LocalDescriptor):
             -cosine distance: this is not a proper distance!
 
         """
-        dm = {'euclidean': lambda x_, y_: norm(x_ - y_),
-              'cosine': lambda x_, y_: dot(x_, y_) / (norm(x_) * norm(y_))
-              }
-
         method = method.lower()
-        if method not in dm.keys():
+        if method not in _DM_VECTOR:
             raise ValueError('Unknown method')
 
-        return dm[method](ft1, ft2)
+        return _DM_VECTOR[method](ft1, ft2)
 
 
 # end HOGDescriptors
@@ -604,7 +876,7 @@ class HistDescriptor(LocalDescriptor):
         if image.ndim != 2:
             raise ValueError("Only grey-level images are supported")
 
-        h, _ = np.histogram(image, normed=True, bins=self.nbins, range=self.interval)
+        h, _ = np.histogram(image, bins=self.nbins, range=self.interval, density=True)
 
         return h
 
@@ -614,8 +886,8 @@ class HistDescriptor(LocalDescriptor):
         Computes the distance between two sets of histogram features.
 
         Args:
-            ft1, ft2: numpy.ndarray (vector)
-            histograms as returned by compute()
+            ft1, ft2: numpy.ndarray (vector) or tuple
+            histograms as returned by compute() or prepare()
 
             method: string
             the method used for computing the distance between the two sets of features:
@@ -624,18 +896,27 @@ class HistDescriptor(LocalDescriptor):
             'bh' - Bhattacharyya distance: -log(sqrt(sum_i (p_i*q_i)))
             'ma' - Matusita distance: sqrt(sum_i (sqrt(p_i)-sqrt(q_i))**2)
         """
-        # distance methods
-        dm = {'kl': lambda x_, y_: 0.5 * (entropy(x_, y_) + entropy(y_, x_)),
-              'js': lambda x_, y_: 0.5 * (entropy(x_, 0.5 * (x_ + y_)) + entropy(y_, 0.5 * (x_ + y_))),
-              'bh': lambda x_, y_: -np.log(np.sum(np.sqrt(x_ * y_))),
-              'ma': lambda x_, y_: np.sqrt(np.sum((np.sqrt(x_) - np.sqrt(y_)) ** 2))
-              }
-
         method = method.lower()
-        if method not in dm.keys():
+        if method not in _DM_HIST:
             raise ValueError('Unknown method')
 
-        return dm[method](ft1, ft2)
+        return _DM_HIST[method](ft1, ft2)
+
+    @staticmethod
+    def prepare(ft):
+        """
+        Prepares a histogram for repeated distance computations (e.g. all
+        pairwise distances): the square roots used by the 'bh' and 'ma' methods
+        are computed only once. The result can be passed to dist() instead of
+        the histogram.
+
+        :param ft: numpy.ndarray
+          A histogram, as returned by compute()
+
+        :return: tuple
+          (ft, sqrt(ft))
+        """
+        return _prepare_hist(ft)
 
 
 # end HistDescriptors
@@ -774,15 +1055,11 @@ class HaarLikeDescriptor(LocalDescriptor):
         :return: a distance
         :rtype: float
         """
-
-        dm = {'euclidean': lambda x_, y_: norm(x_ - y_),
-              'cosine': lambda x_, y_: dot(x_, y_) / (norm(x_) * norm(y_))
-              }
         method = method.lower()
-        if method not in dm.keys():
+        if method not in _DM_VECTOR:
             raise ValueError('Unknown method')
 
-        return dm[method](ft1, ft2)
+        return _DM_VECTOR[method](ft1, ft2)
 
     @staticmethod
     def haars1():